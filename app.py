@@ -1,143 +1,1303 @@
 import os
+import re
 import json
+import math
+import hashlib
+import atexit
+import signal
+import sys
+import mmap
+import bisect
+import random
+import logging
+import logging.handlers
 import threading
+from collections import deque
 import time
+import uuid
 import pika
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import eventlet
+from engineio import packet as eio_packet
+from socketio import packet as sio_packet
+from eventlet.queue import LightQueue, Empty, Full
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 eventlet.monkey_patch()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
 
+# Logging config: records are handed to a writer on a real OS thread so
+# request handlers never wait on stdout; per-message logs are sampled.
+# queue and threading are green after monkey_patch(), and a green writer
+# would block the hub on every stderr write, so use the originals.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+_log_queue = eventlet.patcher.original('queue').Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+def _log_writer():
+    while True:
+        _log_handler.handle(_log_queue.get())
+
+eventlet.patcher.original('threading').Thread(target=_log_writer, name='log-writer', daemon=True).start()
+log = logging.getLogger("chat")
+log.setLevel(LOG_LEVEL)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.propagate = False
+
+def log_sampled():
+    """True for roughly LOG_SAMPLE_RATE of hot-path events"""
+    return LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE
+
 # RabbitMQ config
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
 RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "guest")
 RABBITMQ_VHOST = os.getenv("RABBITMQ_VHOST", "/")
 
-FANOUT_EXCHANGE = "chat.messages"
+# Wire format for AMQP bodies: msgpack or json (consumers accept both)
+BROKER_CODEC = os.getenv("BROKER_CODEC", "msgpack")
+
+ROOM_EXCHANGE = "chat.rooms"
+PRESENCE_EXCHANGE = "chat.presence"
+
+# Identifies this replica in cluster-wide presence events
+INSTANCE_ID = os.getenv("INSTANCE_ID") or uuid.uuid4().hex[:12]
+
+# Outbound publish pipeline config
+PUBLISH_BUFFER_SIZE = int(os.getenv("PUBLISH_BUFFER_SIZE", "10000"))
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "100"))
+PUBLISH_FLUSH_INTERVAL = float(os.getenv("PUBLISH_FLUSH_INTERVAL", "0.01"))
+PUBLISH_IDLE_INTERVAL = float(os.getenv("PUBLISH_IDLE_INTERVAL", "5"))
+PUBLISH_CONNECT_TIMEOUT = float(os.getenv("PUBLISH_CONNECT_TIMEOUT", "5"))
+PUBLISH_RECONNECT_DELAY = float(os.getenv("PUBLISH_RECONNECT_DELAY", "1"))
+PUBLISH_MAX_RECONNECT_DELAY = float(os.getenv("PUBLISH_MAX_RECONNECT_DELAY", "30"))
 
-# Track online users: {sid: nickname}
+# Consumer config
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "200"))
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "100"))
+CONSUMER_POLL_INTERVAL = float(os.getenv("CONSUMER_POLL_INTERVAL", "0.1"))
+CONSUMER_RECONNECT_DELAY = float(os.getenv("CONSUMER_RECONNECT_DELAY", "2"))
+CONSUMER_MAX_RECONNECT_DELAY = float(os.getenv("CONSUMER_MAX_RECONNECT_DELAY", "30"))
+CONSUMER_DEPTH_POLL_INTERVAL = float(os.getenv("CONSUMER_DEPTH_POLL_INTERVAL", "5"))
+
+# Presence config (seconds)
+PRESENCE_DELTA_INTERVAL = float(os.getenv("PRESENCE_DELTA_INTERVAL", "0.5"))
+PRESENCE_HEARTBEAT_INTERVAL = float(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", "10"))
+PRESENCE_SNAPSHOT_INTERVAL = float(os.getenv("PRESENCE_SNAPSHOT_INTERVAL", "30"))
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", "35"))
+
+# Room config
+DEFAULT_ROOM = "general"
+ROOM_NAME_PATTERN = re.compile(r'^[a-z0-9_-]{1,32}$')
+ROOM_BIND_TIMEOUT = float(os.getenv("ROOM_BIND_TIMEOUT", "2"))
+
+# Typing indicator config (seconds)
+TYPING_TICK_INTERVAL = float(os.getenv("TYPING_TICK_INTERVAL", "0.25"))
+TYPING_TTL = float(os.getenv("TYPING_TTL", "3"))
+
+# Per-client outbound queue config
+CLIENT_QUEUE_SIZE = int(os.getenv("CLIENT_QUEUE_SIZE", "1000"))
+CLIENT_OVERFLOW_POLICY = os.getenv("CLIENT_OVERFLOW_POLICY", "drop_oldest")  # drop_oldest | disconnect
+CLIENT_COALESCE_EVENTS = {e for e in os.getenv("CLIENT_COALESCE_EVENTS", "presence_delta,users_list,typing_snapshot").split(",") if e}
+CLIENT_MAX_LAG = float(os.getenv("CLIENT_MAX_LAG", "30"))  # seconds, 0 disables
+CLIENT_SOCKET_HIGH_WATER = int(os.getenv("CLIENT_SOCKET_HIGH_WATER", "64"))
+
+# Message history config
+HISTORY_DIR = os.getenv("HISTORY_DIR", "data/history")
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "200"))
+HISTORY_REPLAY_LIMIT = int(os.getenv("HISTORY_REPLAY_LIMIT", "500"))
+HISTORY_SEGMENT_BYTES = int(os.getenv("HISTORY_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+HISTORY_MAX_SEGMENTS = int(os.getenv("HISTORY_MAX_SEGMENTS", "8"))
+
+# Track online users: {sid: nickname} plus reverse index {nickname: sid}
 online_users = {}
+nickname_index = {}
 users_lock = threading.Lock()
 
+# Local room membership: {sid: room}, {room: {sids}}
+session_rooms = {}
+room_members = {}
+
+# Hashed per-browser-session token from the connect auth: {sid: token_hash}.
+# A rejoin carrying the same token may reclaim a nickname still held by its
+# stale sid (the old socket lingers until the Engine.IO ping timeout).
+session_tokens = {}
+
+# Outbound queue per connected client: {sid: ClientOutbox}
+client_outboxes = {}
+_client_monitor_started = False
+
+# Who is typing per room: {room: {nickname: expires_at}}, rooms changed since last tick
+typing_state = {}
+_typing_dirty = set()
+typing_lock = threading.Lock()
+_typing_started = False
+# When each local typer was last shared with other replicas: {(room, nickname): time}
+_typing_shared = {}
+
+# Users on other replicas: {instance_id: {nicknames}}, {nickname: instance_id}
+remote_users = {}
+remote_index = {}
+remote_seen = {}
+# Session token hash of each remote user, so a rejoin may take its nickname over
+remote_tokens = {}
+
+# Presence changes not yet sent to clients
+_pending_added = set()
+_pending_removed = set()
+_presence_started = False
+
 # RabbitMQ connection
 _connection = None
 _channel = None
 _channel_lock = threading.Lock()
+# Circuit breaker: no connect attempts before this monotonic time
+_reconnect_delay = PUBLISH_RECONNECT_DELAY
+_reconnect_after = 0
 _consumer_started = False
 
+# Bounded publish buffer: items are (exchange, routing_key, payload)
+_publish_buffer = LightQueue(maxsize=PUBLISH_BUFFER_SIZE)
+_publisher_started = False
+
+# Pending queue (un)bindings for the consumer: (action, room, done_event)
+_room_bindings = LightQueue()
+
+# Metrics, rendered in Prometheus text format on /metrics. Updates happen
+# on greenthreads without yield points in between, so no locks are taken.
+METRICS = []
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        METRICS.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+class Gauge:
+    """Gauge that is either set directly or read from a callback at scrape time"""
+
+    def __init__(self, name, description, read=None):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.read = read
+        METRICS.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        value = self.read() if self.read else self.value
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {value}",
+        ]
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        METRICS.append(self)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+messages_in = Counter("chat_messages_in_total", "Chat messages accepted from clients")
+messages_out = Counter("chat_messages_out_total", "Chat messages queued for delivery to local clients")
+publish_failures = Counter("chat_publish_failures_total", "Messages whose broker publish failed")
+fallback_broadcasts = Counter("chat_fallback_broadcasts_total", "Messages delivered locally because the broker path failed")
+consumer_queue_depth = Gauge("chat_consumer_queue_depth", "Deliveries waiting in this replica's broker queue and consumer buffer")
+publish_buffer_depth = Gauge("chat_publish_buffer_depth", "Items waiting in the outbound publish buffer", read=lambda: _publish_buffer.qsize())
+connected_sockets = Gauge("chat_connected_sockets", "Socket.IO clients connected to this replica", read=lambda: len(client_outboxes))
+client_events_dropped = Counter("chat_client_events_dropped_total", "Events dropped from full client outbound queues")
+client_queued_events = Gauge("chat_client_queued_events", "Events waiting in all client outbound queues",
+                             read=lambda: sum(len(outbox.items) for outbox in list(client_outboxes.values())))
+client_max_lag = Gauge("chat_client_max_lag_seconds", "Age of the oldest event waiting for any client",
+                       read=lambda: max((outbox.lag() for outbox in list(client_outboxes.values())), default=0.0))
+delivery_latency = Histogram("chat_delivery_latency_seconds", "Time from send_message to fan-out on the consuming replica")
+broker_publish_time = Histogram("chat_broker_publish_seconds", "Time to publish one batch and receive its confirm")
+
+# Wire codecs. Batches of same-shaped payloads are packed column-wise
+# ({'fields': [...], 'rows': [[...], ...]}) so keys are sent once per batch.
+class JsonCodec:
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+class MsgpackCodec:
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+json_codec = JsonCodec()
+msgpack_codec = MsgpackCodec() if msgpack is not None else None
+CODECS = {codec.content_type: codec for codec in (json_codec, msgpack_codec) if codec}
+
+if BROKER_CODEC == 'msgpack' and msgpack_codec is None:
+    log.warning("⚠️ msgpack is not installed, publishing JSON")
+broker_codec = msgpack_codec if BROKER_CODEC == 'msgpack' and msgpack_codec else json_codec
+
+def pack_envelope(payloads):
+    """Wrap a batch of payloads, column-wise when they all share the same keys"""
+    fields = list(payloads[0]) if isinstance(payloads[0], dict) else None
+    if fields and all(isinstance(p, dict) and len(p) == len(fields) for p in payloads):
+        try:
+            return {'fields': fields, 'rows': [[p[f] for f in fields] for p in payloads]}
+        except KeyError:
+            pass
+    return {'messages': payloads}
+
+def unpack_envelope(envelope):
+    """Inverse of pack_envelope; a bare payload from older publishers is a batch of one"""
+    if isinstance(envelope, dict):
+        if 'rows' in envelope and 'fields' in envelope:
+            fields = envelope['fields']
+            return [dict(zip(fields, row)) for row in envelope['rows']]
+        if 'messages' in envelope:
+            return envelope['messages']
+    return [envelope]
+
 def get_rabbit_connection():
-    """Get or create RabbitMQ connection"""
-    global _connection, _channel
+    """Get or create RabbitMQ connection
+
+    Makes a single bounded connect attempt. After a failure the circuit
+    stays open with exponential backoff, so callers fail fast instead of
+    stalling the publisher while the broker is down.
+    """
+    global _connection, _channel, _reconnect_delay, _reconnect_after
     try:
         if _connection and _connection.is_open and _channel and _channel.is_open:
             return _connection, _channel
     except:
         pass
     
-    max_retries = 3
-    for attempt in range(max_retries):
+    if time.monotonic() < _reconnect_after:
+        raise Exception("RabbitMQ unavailable, waiting before reconnecting")
+    
+    try:
+        creds = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+        params = pika.ConnectionParameters(
+            host=RABBITMQ_HOST,
+            virtual_host=RABBITMQ_VHOST,
+            credentials=creds,
+            heartbeat=600,
+            blocked_connection_timeout=300,
+            connection_attempts=1,
+            socket_timeout=PUBLISH_CONNECT_TIMEOUT
+        )
+        _connection = pika.BlockingConnection(params)
+        _channel = _connection.channel()
+        _channel.exchange_declare(exchange=ROOM_EXCHANGE, exchange_type='topic', durable=True)
+        _channel.exchange_declare(exchange=PRESENCE_EXCHANGE, exchange_type='fanout', durable=True)
+        # Publisher confirms: basic_publish raises if the broker nacks
+        _channel.confirm_delivery()
+    except Exception as e:
+        drop_rabbit_connection()
+        _reconnect_after = time.monotonic() + _reconnect_delay
+        log.error(f"❌ RabbitMQ connection failed, retrying in {_reconnect_delay:.0f}s: {e}")
+        _reconnect_delay = min(_reconnect_delay * 2, PUBLISH_MAX_RECONNECT_DELAY)
+        raise
+    
+    _reconnect_delay = PUBLISH_RECONNECT_DELAY
+    log.info("✅ RabbitMQ connected")
+    return _connection, _channel
+
+def drop_rabbit_connection():
+    """Forget the cached publisher connection so the next call reconnects"""
+    global _connection, _channel
+    try:
+        if _connection and _connection.is_open:
+            _connection.close()
+    except Exception:
+        pass
+    _connection = None
+    _channel = None
+
+def keep_rabbit_connection_alive():
+    """Service heartbeats on the idle publisher connection"""
+    with _channel_lock:
+        if _connection is None:
+            return
         try:
-            creds = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-            params = pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                virtual_host=RABBITMQ_VHOST,
-                credentials=creds,
-                heartbeat=600,
-                blocked_connection_timeout=300,
-                connection_attempts=3,
-                retry_delay=2,
-                socket_timeout=10
-            )
-            _connection = pika.BlockingConnection(params)
-            _channel = _connection.channel()
-            _channel.exchange_declare(exchange=FANOUT_EXCHANGE, exchange_type='fanout', durable=True)
-            print(f"✅ RabbitMQ connected on attempt {attempt + 1}")
-            return _connection, _channel
+            _connection.process_data_events(time_limit=0)
         except Exception as e:
-            print(f"❌ RabbitMQ connection attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2)
-    
-    raise Exception("Failed to connect to RabbitMQ after retries")
+            log.warning(f"⚠️ Idle publisher connection lost: {e}")
+            drop_rabbit_connection()
+
+class MessageHistory:
+    """Per-room ring buffers of recent messages backed by an append-only segment log
+
+    Every delivered message gets a local sequence number and is appended as
+    one JSON line to the active segment file. Segments rotate at
+    HISTORY_SEGMENT_BYTES and only the newest HISTORY_MAX_SEGMENTS are kept.
+    Replays are served from the ring buffer when it reaches back far enough
+    and from memory-mapped segments otherwise. The epoch identifies the log,
+    so sequence cursors from another replica or a wiped disk are ignored.
+    """
+
+    def __init__(self, directory, size, segment_bytes, max_segments):
+        self.directory = directory
+        self.size = size
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.rooms = {}
+        self.segments = []  # [(first_seq, first_timestamp, path)]
+        self.last_seq = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.persistent = False
+        self._file = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        """Load the epoch and rebuild ring buffers from the segments on disk"""
+        os.makedirs(self.directory, exist_ok=True)
+        epoch_path = os.path.join(self.directory, 'epoch')
+        if os.path.exists(epoch_path):
+            with open(epoch_path) as f:
+                self.epoch = f.read().strip()
+        else:
+            with open(epoch_path, 'w') as f:
+                f.write(self.epoch)
+
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith('segment-') and name.endswith('.log')):
+                continue
+            path = os.path.join(self.directory, name)
+            records = self._read_segment(path)
+            if not records:
+                # Empty, or only a torn fragment from a crash right after rotating;
+                # _rotate would reuse the name and append after the fragment
+                if os.path.getsize(path):
+                    log.warning(f"⚠️ Removing segment with no complete record: {path}")
+                os.remove(path)
+                continue
+            self.segments.append((records[0]['seq'], records[0]['timestamp'], path))
+            for msg in records:
+                self._remember(msg)
+            self.last_seq = records[-1]['seq']
+
+        if self.segments:
+            self._truncate_torn_tail(self.segments[-1][2])
+            self._file = open(self.segments[-1][2], 'ab')
+        self.persistent = True
+        log.info(f"✅ History loaded: {len(self.segments)} segments, last seq {self.last_seq}")
+
+    def _read_segment(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            records = []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b''):
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Torn write at the tail after a crash
+                        continue
+            return records
+
+    def _truncate_torn_tail(self, path):
+        """Cut a partial record left by a crash so new appends start on a fresh line"""
+        with open(path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = mm.rfind(b'\n') + 1
+            if end < size:
+                log.warning(f"⚠️ Truncating {size - end} torn bytes from {path}")
+                f.truncate(end)
+
+    def _remember(self, msg):
+        room = self.rooms.get(msg['room'])
+        if room is None:
+            room = self.rooms[msg['room']] = deque(maxlen=self.size)
+        room.append(msg)
+
+    def _rotate(self, first):
+        if self._file:
+            self._file.close()
+        path = os.path.join(self.directory, f"segment-{first['seq']:020d}.log")
+        self._file = open(path, 'ab')
+        self.segments.append((first['seq'], first['timestamp'], path))
+        while len(self.segments) > self.max_segments:
+            _, _, old_path = self.segments.pop(0)
+            os.remove(old_path)
+
+    def append(self, messages):
+        """Assign sequence numbers and record a batch with one write"""
+        with self._lock:
+            for msg in messages:
+                self.last_seq += 1
+                msg['seq'] = self.last_seq
+                msg.setdefault('room', DEFAULT_ROOM)
+                self._remember(msg)
+
+            if not self.persistent:
+                return
+            try:
+                if self._file is None or self._file.tell() >= self.segment_bytes:
+                    self._rotate(messages[0])
+                self._file.write(b''.join(json.dumps(msg).encode() + b'\n' for msg in messages))
+                self._file.flush()
+            except OSError as e:
+                log.error(f"❌ History write error: {e}")
+
+    def replay(self, room, cursor=None, since=None, until=None, limit=HISTORY_REPLAY_LIMIT):
+        """Messages in room after a seq cursor or timestamp and up to seq until, oldest first"""
+        with self._lock:
+            buffered = list(self.rooms.get(room, ()))
+            segments = list(self.segments)
+        # A ring buffer that is not full holds everything recorded for the room
+        complete = not self.persistent or len(buffered) < self.size
+        if until is not None:
+            buffered = [msg for msg in buffered if msg['seq'] <= until]
+
+        if cursor is not None:
+            key, after = 'seq', cursor
+        elif since is not None:
+            key, after = 'timestamp', since
+        else:
+            return buffered[-limit:]
+
+        # ...as does one that reaches back past the cursor
+        if complete or (buffered and buffered[0][key] <= after):
+            return [msg for msg in buffered if msg[key] > after][-limit:]
+
+        position = 0 if key == 'seq' else 1
+        start = 0
+        for i, segment in enumerate(segments):
+            if segment[position] <= after:
+                start = i
+
+        result = deque(maxlen=limit)
+        for _, _, path in segments[start:]:
+            try:
+                records = self._read_segment(path)
+            except FileNotFoundError:
+                # Rotated away while we were reading
+                continue
+            for msg in records:
+                if until is not None and msg['seq'] > until:
+                    break
+                if msg[key] > after and msg['room'] == room:
+                    result.append(msg)
+        return list(result)
+
+history = MessageHistory(HISTORY_DIR, HISTORY_SIZE, HISTORY_SEGMENT_BYTES, HISTORY_MAX_SEGMENTS)
+try:
+    history.open()
+except OSError as e:
+    log.error(f"❌ History disabled, keeping messages in memory only: {e}")
+
+class ClientOutbox:
+    """Bounded outbound queue for one client, drained by its own writer greenthread
+
+    Fan-out only appends here, so a stalled websocket or long-polling client
+    backs up its own queue instead of slowing delivery to everyone else. The
+    writer hands events to the Engine.IO socket only while that socket's
+    queue is below CLIENT_SOCKET_HIGH_WATER. When full, the oldest item is
+    dropped (or the client disconnected, per CLIENT_OVERFLOW_POLICY), and
+    presence/typing events in CLIENT_COALESCE_EVENTS are merged with the
+    pending one instead of queued again. Items carry the Engine.IO packets
+    encoded once per fan-out; merged events are encoded by the writer.
+    Only touched from greenthreads, and put() has no yield points (under the
+    disconnect policy it only flags the outbox for the client monitor), so
+    no lock is needed.
+    """
+
+    def __init__(self, sid, binary=False):
+        self.sid = sid
+        self.binary = binary  # client negotiated msgpack message_batch_bin packets
+        self.items = deque()  # [event, data, enqueued_at, packets]; event None is a tombstone
+        self.pending = {}     # coalescable event -> its queued item
+        self.closed = False
+        self.held = False
+        self.overflowed = False  # disconnect policy: the monitor drops this client
+        self._wakeup = threading.Event()
+
+    def lag(self):
+        """Seconds the oldest queued event has been waiting"""
+        for event, data, enqueued_at, packets in self.items:
+            if event is not None:
+                return time.monotonic() - enqueued_at
+        return 0.0
+
+    def put(self, event, data, packets=None):
+        """Queue an event; packets is its pre-encoded form when shared by a fan-out"""
+        if self.closed or self.overflowed:
+            return
+        if event in CLIENT_COALESCE_EVENTS and self._coalesce(event, data, packets):
+            return
+        if len(self.items) >= CLIENT_QUEUE_SIZE:
+            if CLIENT_OVERFLOW_POLICY == 'disconnect':
+                self.overflowed = True
+                return
+            self._drop_oldest()
+        item = [event, data, time.monotonic(), packets]
+        self.items.append(item)
+        if event in CLIENT_COALESCE_EVENTS:
+            self.pending[event] = item
+        self._wakeup.set()
+
+    def _coalesce(self, event, data, packets):
+        """Merge into a pending event of the same kind; False if nothing to merge into"""
+        if event == 'presence_delta':
+            users_list = self.pending.get('users_list')
+            if users_list is not None:
+                # Fold the delta into the pending full snapshot
+                removed = set(data['removed'])
+                users = [u for u in users_list[1]['users'] if u not in removed]
+                users.extend(u for u in data['added'] if u not in users)
+                users_list[1] = {'users': users}
+                users_list[3] = None
+                return True
+            delta = self.pending.get('presence_delta')
+            if delta is not None:
+                added, removed = set(delta[1]['added']), set(delta[1]['removed'])
+                for nickname in data['removed']:
+                    if nickname in added:
+                        added.discard(nickname)
+                    else:
+                        removed.add(nickname)
+                for nickname in data['added']:
+                    if nickname in removed:
+                        removed.discard(nickname)
+                    else:
+                        added.add(nickname)
+                delta[1] = {'added': list(added), 'removed': list(removed)}
+                delta[3] = None
+                return True
+            return False
+
+        if event == 'users_list':
+            # A full snapshot supersedes any pending delta
+            delta = self.pending.pop('presence_delta', None)
+            if delta is not None:
+                delta[0] = None
+
+        # Snapshots simply replace the pending one
+        item = self.pending.get(event)
+        if item is None:
+            return False
+        item[1] = data
+        item[3] = packets
+        return True
+
+    def _take(self):
+        item = self.items.popleft()
+        if self.pending.get(item[0]) is item:
+            del self.pending[item[0]]
+        return item
+
+    def _drop_oldest(self):
+        event, data, enqueued_at, packets = self._take()
+        if event is not None:
+            client_events_dropped.inc()
+
+    def hold(self):
+        """Keep queueing but stop forwarding until release()"""
+        self.held = True
+
+    def release(self, event=None, data=None):
+        """Resume forwarding, optionally sending one event ahead of everything queued"""
+        if event is not None:
+            self.items.appendleft([event, data, time.monotonic(), None])
+        self.held = False
+        self._wakeup.set()
+
+    def close(self):
+        self.closed = True
+        self.items.clear()
+        self.pending.clear()
+        self._wakeup.set()
+
+    def run(self):
+        """Writer loop: forward queued events as the client's socket drains"""
+        while not self.closed:
+            if self.held or not self.items:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            # Backpressure: leave events here while the socket is still busy
+            if _socket_backlog(self.sid) >= CLIENT_SOCKET_HIGH_WATER:
+                socketio.sleep(0.01)
+                continue
+            event, data, enqueued_at, packets = self._take()
+            if event is None:
+                continue
+            try:
+                _send_packets(self.sid, packets or encode_event(event, data))
+            except Exception:
+                # Lose this one event, not the client's writer
+                log.exception(f"❌ Failed to send {event} to {self.sid}")
+
+def encode_event(event, data):
+    """Engine.IO packets for a Socket.IO event, shareable by every recipient"""
+    pkt = socketio.server.packet_class(sio_packet.EVENT, namespace='/', data=[event, data])
+    encoded = pkt.encode()
+    if not isinstance(encoded, list):
+        encoded = [encoded]  # binary events encode to a header plus attachments
+    return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+
+def _send_packets(sid, packets):
+    eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+    if eio_sid is None:
+        return
+    for p in packets:
+        socketio.server.eio.send_packet(eio_sid, p)
+
+def _socket_backlog(sid):
+    """Packets queued on the client's Engine.IO socket and not yet sent"""
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+        return socketio.server.eio.sockets[eio_sid].queue.qsize()
+    except (KeyError, AttributeError):
+        return 0
+
+def open_outbox(sid, binary=False):
+    outbox = ClientOutbox(sid, binary)
+    client_outboxes[sid] = outbox
+    socketio.start_background_task(outbox.run)
+
+def close_outbox(sid):
+    outbox = client_outboxes.pop(sid, None)
+    if outbox is not None:
+        outbox.close()
+
+def fan_out(event, data, sids=None):
+    """Queue an event for the given clients, or for every connected client
+
+    The event is encoded once here and the packets are shared by every outbox.
+    """
+    if sids is None:
+        outboxes = list(client_outboxes.values())
+    else:
+        outboxes = [client_outboxes[sid] for sid in sids if sid in client_outboxes]
+    if not outboxes:
+        return
+    packets = encode_event(event, data)
+    for outbox in outboxes:
+        outbox.put(event, data, packets)
+
+def disconnect_client(sid, reason):
+    log.warning(f"⚠️ Disconnecting slow client {sid}: {reason}")
+    close_outbox(sid)
+    socketio.server.disconnect(sid, namespace='/')
+
+def start_client_monitor():
+    """Start the loop that disconnects clients lagging more than CLIENT_MAX_LAG
+    or whose outbound queue overflowed under the disconnect policy"""
+    global _client_monitor_started
+    if _client_monitor_started:
+        return
+    _client_monitor_started = True
+
+    def monitor_loop():
+        while True:
+            socketio.sleep(1)
+            for sid, outbox in list(client_outboxes.items()):
+                try:
+                    if outbox.overflowed:
+                        disconnect_client(sid, "outbound queue full")
+                        continue
+                    lag = outbox.lag()
+                    if CLIENT_MAX_LAG > 0 and lag > CLIENT_MAX_LAG:
+                        disconnect_client(sid, f"{lag:.1f}s behind")
+                except Exception:
+                    log.exception(f"❌ Client monitor error for {sid}")
+
+    socketio.start_background_task(monitor_loop)
+
+def room_routing_key(room):
+    return f"room.{room}"
+
+def typing_routing_key(room):
+    return f"room.{room}.typing"
+
+def room_binding_key(room):
+    """Binding pattern covering a room's messages and typing changes"""
+    return f"room.{room}.#"
+
+def _is_typing_key(routing_key):
+    # Room names never contain dots, so only typing keys have three words
+    return routing_key.count('.') == 2 and routing_key.endswith('.typing')
+
+def deliver_messages(messages):
+    """Record chat messages in history and emit them to local room members, one event per room"""
+    history.append(messages)
+    now = time.time()
+    by_room = {}
+    for msg in messages:
+        by_room.setdefault(msg['room'], []).append(msg)
+        delivery_latency.observe(max(now - msg['timestamp'], 0))
+    for room, room_messages in by_room.items():
+        with users_lock:
+            members = list(room_members.get(room, ()))
+        payload = {'messages': room_messages}
+        # Each form is encoded once per batch and shared by every client using it
+        packed = packed_packets = json_packets = None
+        for sid in members:
+            outbox = client_outboxes.get(sid)
+            if outbox is None:
+                continue
+            if outbox.binary:
+                if packed is None:
+                    packed = msgpack_codec.encode(pack_envelope(room_messages))
+                    packed_packets = encode_event('message_batch_bin', packed)
+                outbox.put('message_batch_bin', packed, packed_packets)
+            else:
+                if json_packets is None:
+                    json_packets = encode_event('message_batch', payload)
+                outbox.put('message_batch', payload, json_packets)
+        messages_out.inc(len(room_messages) * len(members))
+
+def _enqueue_publish(exchange, routing_key, payload):
+    """Queue payload for the background publisher; never blocks on the broker"""
+    try:
+        _publish_buffer.put_nowait((exchange, routing_key, payload))
+        return True
+    except Full:
+        return False
 
 def publish_message(msg_data):
-    """Publish message to RabbitMQ fanout exchange"""
+    """Queue chat message for publishing to its room on the RabbitMQ topic exchange"""
+    if not _enqueue_publish(ROOM_EXCHANGE, room_routing_key(msg_data['room']), msg_data):
+        if log_sampled():
+            log.warning("⚠️ Publish buffer full, falling back to direct Socket.IO broadcast")
+        fallback_broadcasts.inc()
+        deliver_messages([msg_data])
+
+def _drain_publish_buffer():
+    """Wait for the next item, then collect a micro-batch of up to
+    PUBLISH_BATCH_SIZE items within PUBLISH_FLUSH_INTERVAL
+
+    Returns an empty batch after PUBLISH_IDLE_INTERVAL without traffic.
+    """
     try:
-        with _channel_lock:
-            conn, ch = get_rabbit_connection()
-            ch.basic_publish(
-                exchange=FANOUT_EXCHANGE,
-                routing_key='',
-                body=json.dumps(msg_data).encode(),
-                properties=pika.BasicProperties(delivery_mode=2)
+        batch = [_publish_buffer.get(timeout=PUBLISH_IDLE_INTERVAL)]
+    except Empty:
+        return []
+    deadline = time.monotonic() + PUBLISH_FLUSH_INTERVAL
+    while len(batch) < PUBLISH_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_publish_buffer.get(timeout=remaining))
+        except Empty:
+            break
+    return batch
+
+def _publish_body(exchange, routing_key, body):
+    with _channel_lock:
+        conn, ch = get_rabbit_connection()
+        started = time.monotonic()
+        ch.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                content_type=broker_codec.content_type
             )
-            print(f"✅ Message published: {msg_data['from']}: {msg_data['text'][:30]}...")
-    except Exception as e:
-        print(f"❌ Publish error: {e}")
-        # Fallback: broadcast directly via Socket.IO
-        print("⚠️ Falling back to direct Socket.IO broadcast")
-        socketio.emit('message', msg_data, namespace='/')
+        )
+        broker_publish_time.observe(time.monotonic() - started)
+
+def _flush_batch(batch):
+    """Publish one confirmed envelope per (exchange, routing_key) group"""
+    groups = {}
+    for exchange, routing_key, payload in batch:
+        groups.setdefault((exchange, routing_key), []).append(payload)
+
+    for (exchange, routing_key), payloads in groups.items():
+        body = broker_codec.encode(pack_envelope(payloads))
+        try:
+            try:
+                _publish_body(exchange, routing_key, body)
+            except Exception as e:
+                # The cached connection may have died while idle; reconnect and retry once
+                log.warning(f"⚠️ Publish failed, reconnecting and retrying: {e}")
+                with _channel_lock:
+                    drop_rabbit_connection()
+                _publish_body(exchange, routing_key, body)
+        except Exception as e:
+            log.error(f"❌ Publish error ({len(payloads)} messages): {e}")
+            publish_failures.inc(len(payloads))
+            # Presence is repaired by the next heartbeat snapshot, typing expires on its own
+            if exchange == ROOM_EXCHANGE and not _is_typing_key(routing_key):
+                # Fallback: broadcast directly via Socket.IO
+                log.warning("⚠️ Falling back to direct Socket.IO broadcast")
+                fallback_broadcasts.inc(len(payloads))
+                deliver_messages(payloads)
+
+def start_publisher():
+    """Start the batching RabbitMQ publisher as a background greenthread"""
+    global _publisher_started
+    if _publisher_started:
+        return
+    _publisher_started = True
+
+    def publish_loop():
+        log.info("RabbitMQ publisher started")
+        while True:
+            batch = _drain_publish_buffer()
+            if not batch:
+                keep_rabbit_connection_alive()
+                continue
+            try:
+                _flush_batch(batch)
+            except Exception as e:
+                log.error(f"Publisher error: {e}")
+
+    socketio.start_background_task(publish_loop)
+
+def decode_envelope(body, content_type=None):
+    """Decode an AMQP body into a list of payloads"""
+    codec = CODECS.get(content_type, json_codec)
+    return unpack_envelope(codec.decode(body))
+
+def _is_chat_message(payload):
+    """True if payload has what deliver_messages needs, so one bad message cannot sink its batch"""
+    return (isinstance(payload, dict) and isinstance(payload.get('room'), str)
+            and isinstance(payload.get('timestamp'), (int, float)))
+
+def _process_deliveries(ch, deliveries):
+    """Emit a batch of deliveries in one pass and ack them together"""
+    messages = []
+    presence = []
+    typing = []
+    for method, properties, body in deliveries:
+        try:
+            payloads = decode_envelope(body, properties.content_type)
+        except Exception as e:
+            # Malformed bodies are dropped; requeueing would redeliver them forever
+            log.error(f"Consumer decode error: {e}")
+            continue
+        if method.exchange == PRESENCE_EXCHANGE:
+            presence.extend(payloads)
+        elif _is_typing_key(method.routing_key):
+            typing.extend(payloads)
+        else:
+            valid = [p for p in payloads if _is_chat_message(p)]
+            if len(valid) < len(payloads):
+                log.warning(f"⚠️ Consumer dropped {len(payloads) - len(valid)} malformed messages")
+            messages.extend(valid)
+
+    # A bad payload must not end the consume loop: closing the connection
+    # would delete the exclusive queue with everything still unacked in it
+    for handler, payloads in ((apply_remote_presence, presence), (apply_remote_typing, typing),
+                              (deliver_messages, messages)):
+        if not payloads:
+            continue
+        try:
+            handler(payloads)
+        except Exception:
+            log.exception(f"❌ Consumer failed to handle {len(payloads)} payloads in {handler.__name__}")
+    ch.basic_ack(delivery_tag=deliveries[-1][0].delivery_tag, multiple=True)
+
+def request_room_binding(action, room, wait=False):
+    """Ask the consumer to bind or unbind this replica's queue for a room
+
+    Exclusive queues can only be (un)bound from the connection that declared
+    them, so the consumer applies these between batches. With wait=True the
+    caller blocks for up to ROOM_BIND_TIMEOUT until the binding is live.
+    """
+    done = threading.Event()
+    _room_bindings.put((action, room, done))
+    if wait and not done.wait(ROOM_BIND_TIMEOUT):
+        log.warning(f"⚠️ Timed out waiting to {action} room {room}")
+
+def _apply_room_bindings(ch, queue_name):
+    while True:
+        try:
+            action, room, done = _room_bindings.get_nowait()
+        except Empty:
+            return
+        if action == 'bind':
+            ch.queue_bind(exchange=ROOM_EXCHANGE, queue=queue_name, routing_key=room_binding_key(room))
+        else:
+            ch.queue_unbind(exchange=ROOM_EXCHANGE, queue=queue_name, routing_key=room_binding_key(room))
+        done.set()
+
+def _consume_batches(ch, queue_name):
+    """Drain deliveries into batches until the connection fails
+
+    A batch is flushed as soon as no more deliveries are already buffered
+    locally, so a quiet queue adds no latency and a busy one batches itself.
+    Pending room (un)bindings are applied between batches.
+    """
+    batch = []
+    next_depth_poll = 0
+    for method, properties, body in ch.consume(queue_name, inactivity_timeout=CONSUMER_POLL_INTERVAL):
+        if method is not None:
+            batch.append((method, properties, body))
+            if len(batch) < CONSUMER_BATCH_SIZE and ch.get_waiting_message_count():
+                continue
+        if batch:
+            _process_deliveries(ch, batch)
+            batch = []
+        _apply_room_bindings(ch, queue_name)
+
+        now = time.monotonic()
+        if now >= next_depth_poll:
+            next_depth_poll = now + CONSUMER_DEPTH_POLL_INTERVAL
+            result = ch.queue_declare(queue=queue_name, passive=True)
+            consumer_queue_depth.set(result.method.message_count + ch.get_waiting_message_count())
 
 def start_consumer():
-    """Start RabbitMQ consumer in background thread"""
+    """Start RabbitMQ consumer as a background greenthread"""
     global _consumer_started
     if _consumer_started:
         return
     _consumer_started = True
     
     def consume():
-        creds = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-        params = pika.ConnectionParameters(
-            host=RABBITMQ_HOST,
-            virtual_host=RABBITMQ_VHOST,
-            credentials=creds,
-            heartbeat=600
-        )
-        conn = pika.BlockingConnection(params)
-        ch = conn.channel()
-        ch.exchange_declare(exchange=FANOUT_EXCHANGE, exchange_type='fanout', durable=True)
-        
-        # Create exclusive queue for this instance
-        result = ch.queue_declare(queue='', exclusive=True)
-        queue_name = result.method.queue
-        ch.queue_bind(exchange=FANOUT_EXCHANGE, queue=queue_name)
-        
-        def callback(chh, method, properties, body):
+        delay = CONSUMER_RECONNECT_DELAY
+        while True:
+            conn = None
             try:
-                msg = json.loads(body.decode())
-                # Emit to all connected clients via Socket.IO
-                socketio.emit('message', msg)
-                chh.basic_ack(delivery_tag=method.delivery_tag)
+                creds = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
+                params = pika.ConnectionParameters(
+                    host=RABBITMQ_HOST,
+                    virtual_host=RABBITMQ_VHOST,
+                    credentials=creds,
+                    heartbeat=600
+                )
+                conn = pika.BlockingConnection(params)
+                ch = conn.channel()
+                ch.exchange_declare(exchange=ROOM_EXCHANGE, exchange_type='topic', durable=True)
+                
+                # Create exclusive queue for this instance, bound only to rooms with local members
+                result = ch.queue_declare(queue='', exclusive=True)
+                queue_name = result.method.queue
+                with users_lock:
+                    rooms = list(room_members)
+                for room in rooms:
+                    ch.queue_bind(exchange=ROOM_EXCHANGE, queue=queue_name, routing_key=room_binding_key(room))
+                ch.exchange_declare(exchange=PRESENCE_EXCHANGE, exchange_type='fanout', durable=True)
+                ch.queue_bind(exchange=PRESENCE_EXCHANGE, queue=queue_name)
+                ch.basic_qos(prefetch_count=CONSUMER_PREFETCH)
+                
+                log.info("RabbitMQ consumer started")
+                delay = CONSUMER_RECONNECT_DELAY
+                _consume_batches(ch, queue_name)
             except Exception as e:
-                print(f"Consumer callback error: {e}")
-                chh.basic_nack(delivery_tag=method.delivery_tag)
-        
-        ch.basic_qos(prefetch_count=10)
-        ch.basic_consume(queue=queue_name, on_message_callback=callback)
-        
-        try:
-            print("RabbitMQ consumer started")
-            ch.start_consuming()
-        except Exception as e:
-            print(f"Consumer error: {e}")
-            try:
-                ch.close()
-                conn.close()
-            except:
-                pass
+                log.error(f"Consumer error: {e}")
+            finally:
+                try:
+                    if conn and conn.is_open:
+                        conn.close()
+                except:
+                    pass
+            
+            log.warning(f"⚠️ Consumer reconnecting in {delay:.0f}s")
+            socketio.sleep(delay)
+            delay = min(delay * 2, CONSUMER_MAX_RECONNECT_DELAY)
     
-    threading.Thread(target=consume, daemon=True).start()
+    socketio.start_background_task(consume)
+
+def _is_online(nickname):
+    """O(1) cluster-wide lookup; caller holds users_lock"""
+    return nickname in nickname_index or nickname in remote_index
+
+def _all_users():
+    """Every nickname online in the cluster; caller holds users_lock"""
+    return list(nickname_index) + [n for n in remote_index if n not in nickname_index]
+
+def _note_presence(added=(), removed=()):
+    """Record visible presence changes for the next delta; caller holds users_lock
+
+    A nickname added and removed within one interval cancels out, so a
+    reconnect storm collapses into a single compact delta per interval.
+    """
+    for nickname in added:
+        if nickname in _pending_removed:
+            _pending_removed.discard(nickname)
+        else:
+            _pending_added.add(nickname)
+    for nickname in removed:
+        if nickname in _pending_added:
+            _pending_added.discard(nickname)
+        else:
+            _pending_removed.add(nickname)
+
+def _publish_presence(event):
+    """Share a local presence change with the other replicas"""
+    event['instance'] = INSTANCE_ID
+    _enqueue_publish(PRESENCE_EXCHANGE, '', event)
+
+def _local_tokens(nicknames):
+    """Session token hashes of local users; caller holds users_lock"""
+    tokens = {}
+    for nickname in nicknames:
+        token = session_tokens.get(nickname_index.get(nickname))
+        if token:
+            tokens[nickname] = token
+    return tokens
+
+def _publish_presence_snapshot():
+    with users_lock:
+        users = list(nickname_index)
+        tokens = _local_tokens(users)
+    _publish_presence({'snapshot': users, 'tokens': tokens})
+
+def _remote_reclaimable(nickname, sid):
+    """True when a remote replica holds nickname for this sid's session; caller holds users_lock"""
+    token = session_tokens.get(sid)
+    return bool(token) and nickname in remote_index and remote_tokens.get(nickname) == token
+
+def announce_shutdown():
+    """Tell other replicas our users are gone instead of letting them wait out PRESENCE_TTL"""
+    event = {'instance': INSTANCE_ID, 'snapshot': [], 'shutdown': True}
+    try:
+        _publish_body(PRESENCE_EXCHANGE, '', broker_codec.encode(pack_envelope([event])))
+        log.info("👋 Announced shutdown to other replicas")
+    except Exception as e:
+        log.warning(f"⚠️ Could not announce shutdown: {e}")
+
+def apply_remote_presence(events):
+    """Merge presence deltas and snapshots published by other replicas"""
+    now = time.time()
+    new_instance = False
+    evicted = []
+    with users_lock:
+        for event in events:
+            instance = event.get('instance')
+            if not instance or instance == INSTANCE_ID:
+                continue
+            if event.get('shutdown'):
+                # Replica stopped cleanly: drop its users now
+                _set_remote_users(instance, (), set(remote_users.pop(instance, ())))
+                remote_seen.pop(instance, None)
+                continue
+            if 'evict' in event:
+                # Another replica took over a nickname for the same session
+                old_sid = nickname_index.get(event['evict'])
+                if old_sid and event.get('token') and session_tokens.get(old_sid) == event['token']:
+                    evicted.append(old_sid)
+            if instance not in remote_seen:
+                new_instance = True
+            remote_seen[instance] = now
+            users = remote_users.setdefault(instance, set())
+            if 'snapshot' in event:
+                snapshot = set(event['snapshot'])
+                added = snapshot - users
+                removed = users - snapshot
+            else:
+                added = set(event.get('added', ())) - users
+                removed = set(event.get('removed', ())) & users
+            _set_remote_users(instance, added, removed, event.get('tokens'))
+    for sid in evicted:
+        log.info(f"Session {sid} taken over by another replica")
+        close_outbox(sid)
+        socketio.server.disconnect(sid, namespace='/')
+    # Let a replica that just appeared learn our users without waiting a heartbeat
+    if new_instance:
+        _publish_presence_snapshot()
+
+def _set_remote_users(instance, added, removed, tokens=None):
+    """Apply one replica's membership change; caller holds users_lock"""
+    users = remote_users.setdefault(instance, set())
+    visible_added = [n for n in added if not _is_online(n)]
+    for nickname in added:
+        users.add(nickname)
+        remote_index[nickname] = instance
+    for nickname, token in (tokens or {}).items():
+        if remote_index.get(nickname) == instance:
+            remote_tokens[nickname] = token
+    for nickname in removed:
+        users.discard(nickname)
+        if remote_index.get(nickname) == instance:
+            del remote_index[nickname]
+            remote_tokens.pop(nickname, None)
+    visible_removed = [n for n in removed if not _is_online(n)]
+    _note_presence(visible_added, visible_removed)
+
+def _expire_remote_presence(now):
+    """Drop users of replicas that stopped sending heartbeats"""
+    with users_lock:
+        for instance, seen in list(remote_seen.items()):
+            if now - seen > PRESENCE_TTL:
+                log.warning(f"⚠️ Presence expired for instance {instance}")
+                _set_remote_users(instance, (), set(remote_users.get(instance, ())))
+                remote_users.pop(instance, None)
+                del remote_seen[instance]
+
+def flush_presence_delta():
+    """Emit accumulated presence changes as one compact event"""
+    with users_lock:
+        if not _pending_added and not _pending_removed:
+            return
+        delta = {'added': list(_pending_added), 'removed': list(_pending_removed)}
+        _pending_added.clear()
+        _pending_removed.clear()
+    fan_out('presence_delta', delta)
 
 def broadcast_users_list():
     """Broadcast current online users to all clients"""
     with users_lock:
-        users = list(online_users.values())
-    socketio.emit('users_list', {'users': users}, namespace='/')
+        users = _all_users()
+    fan_out('users_list', {'users': users})
+
+def start_presence():
+    """Start the presence heartbeat, delta and snapshot loop"""
+    global _presence_started
+    if _presence_started:
+        return
+    _presence_started = True
+
+    def presence_loop():
+        last_heartbeat = 0
+        last_snapshot = time.time()
+        while True:
+            try:
+                now = time.time()
+                if now - last_heartbeat >= PRESENCE_HEARTBEAT_INTERVAL:
+                    last_heartbeat = now
+                    _publish_presence_snapshot()
+                    _expire_remote_presence(now)
+                flush_presence_delta()
+                # Periodic full snapshot repairs any client that missed a delta
+                if now - last_snapshot >= PRESENCE_SNAPSHOT_INTERVAL:
+                    last_snapshot = now
+                    broadcast_users_list()
+            except Exception:
+                log.exception("❌ Presence loop error")
+            socketio.sleep(PRESENCE_DELTA_INTERVAL)
+
+    socketio.start_background_task(presence_loop)
+
+def set_typing(room, nickname, is_typing):
+    """Record a typing state change; it reaches clients on the next tick
+
+    Returns True when other replicas should hear about it: the typer
+    started, stopped, or has not been refreshed there for TYPING_TTL / 2.
+    """
+    now = time.time()
+    with typing_lock:
+        typers = typing_state.setdefault(room, {})
+        if is_typing:
+            if nickname not in typers:
+                _typing_dirty.add(room)
+            typers[nickname] = now + TYPING_TTL
+            if now - _typing_shared.get((room, nickname), 0) < TYPING_TTL / 2:
+                return False
+            _typing_shared[(room, nickname)] = now
+            return True
+        _typing_shared.pop((room, nickname), None)
+        if typers.pop(nickname, None) is not None:
+            _typing_dirty.add(room)
+            return True
+        return False
+
+def share_typing(room, nickname, is_typing):
+    """Apply a local user's typing change and share it with replicas hosting the room"""
+    if set_typing(room, nickname, is_typing):
+        _enqueue_publish(ROOM_EXCHANGE, typing_routing_key(room), {
+            'room': room, 'nickname': nickname, 'typing': is_typing, 'instance': INSTANCE_ID})
+
+def apply_remote_typing(events):
+    """Merge typing changes from other replicas; remote typers expire like local ones"""
+    for event in events:
+        if not isinstance(event, dict) or event.get('instance') == INSTANCE_ID:
+            continue
+        room, nickname = event.get('room'), event.get('nickname')
+        if isinstance(room, str) and isinstance(nickname, str):
+            set_typing(room, nickname, bool(event.get('typing')))
+
+def flush_typing_snapshots():
+    """Expire stale typers and emit one snapshot per changed room"""
+    now = time.time()
+    snapshots = {}
+    with typing_lock:
+        for room, typers in list(typing_state.items()):
+            expired = [nickname for nickname, expires_at in typers.items() if expires_at <= now]
+            for nickname in expired:
+                del typers[nickname]
+                _typing_shared.pop((room, nickname), None)
+            if expired:
+                _typing_dirty.add(room)
+            if not typers:
+                del typing_state[room]
+        for room in _typing_dirty:
+            snapshots[room] = list(typing_state.get(room, ()))
+        _typing_dirty.clear()
+
+    for room, users in snapshots.items():
+        with users_lock:
+            members = list(room_members.get(room, ()))
+        fan_out('typing_snapshot', {'users': users}, members)
+
+def start_typing():
+    """Start the typing indicator aggregation loop"""
+    global _typing_started
+    if _typing_started:
+        return
+    _typing_started = True
+
+    def typing_loop():
+        while True:
+            try:
+                flush_typing_snapshots()
+            except Exception:
+                log.exception("❌ Typing loop error")
+            socketio.sleep(TYPING_TICK_INTERVAL)
+
+    socketio.start_background_task(typing_loop)
 
 @app.route('/')
 def index():
@@ -147,88 +1307,214 @@ def index():
 def health():
     return jsonify({"status": "ok"})
 
+@app.route('/metrics')
+def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
 @socketio.on('connect')
-def handle_connect():
-    print(f"Client connected: {request.sid}")
+def handle_connect(auth=None):
+    log.info(f"Client connected: {request.sid}")
+    # Clients that can decode MessagePack ask for binary message batches
+    codec = auth.get('codec') if isinstance(auth, dict) else None
+    open_outbox(request.sid, binary=codec == 'msgpack' and msgpack_codec is not None)
+    token = auth.get('token') if isinstance(auth, dict) else None
+    if isinstance(token, str) and 0 < len(token) <= 128:
+        session_tokens[request.sid] = hashlib.sha256(token.encode()).hexdigest()[:32]
+    start_client_monitor()
     start_consumer()
+    start_publisher()
+    start_presence()
+    start_typing()
 
 @socketio.on('disconnect')
 def handle_disconnect():
     sid = request.sid
+    close_outbox(sid)
+    session_tokens.pop(sid, None)
     with users_lock:
-        if sid in online_users:
-            nickname = online_users.pop(sid)
-            print(f"User disconnected: {nickname}")
-            # Notify others
-            emit('user_left', {'nickname': nickname}, broadcast=True)
-            broadcast_users_list()
+        nickname = online_users.pop(sid, None)
+        if nickname is None:
+            return
+        del nickname_index[nickname]
+        if not _is_online(nickname):
+            _note_presence(removed=[nickname])
+        room = session_rooms.pop(sid)
+        members = room_members[room]
+        members.discard(sid)
+        last_member = not members
+        if last_member:
+            del room_members[room]
+    
+    log.info(f"User disconnected: {nickname}")
+    share_typing(room, nickname, False)
+    # Stop receiving the room's traffic once nobody here is in it
+    if last_member:
+        request_room_binding('unbind', room)
+    # Others learn about it from the next presence delta
+    _publish_presence({'removed': [nickname]})
+
+def _as_number(value, kind):
+    """Parse a client-supplied cursor; anything non-numeric or non-finite is ignored"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+        if not math.isfinite(number):
+            return None
+        return kind(number)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def _reclaimable_sid(nickname, sid):
+    """Local sid holding nickname for the same session token; caller holds users_lock"""
+    old_sid = nickname_index.get(nickname)
+    token = session_tokens.get(sid)
+    if old_sid and old_sid != sid and token and session_tokens.get(old_sid) == token:
+        return old_sid
+    return None
 
 @socketio.on('join')
 def handle_join(data):
-    nickname = data.get('nickname', '').strip()
-    if not nickname:
+    if not isinstance(data, dict):
+        return
+    nickname = data.get('nickname')
+    if not isinstance(nickname, str) or not nickname.strip():
+        return
+    nickname = nickname.strip()
+    
+    room = data.get('room') or DEFAULT_ROOM
+    if isinstance(room, str):
+        room = room.strip().lower()
+    if not isinstance(room, str) or not ROOM_NAME_PATTERN.match(room):
+        emit('join_error', {'error': 'Invalid room name'})
         return
     
     sid = request.sid
+    takeover = False
+    with users_lock:
+        stale_sid = _reclaimable_sid(nickname, sid)
+        if not stale_sid and _remote_reclaimable(nickname, sid):
+            # Same session rejoining through this replica; the owner evicts its stale sid
+            _set_remote_users(remote_index[nickname], (), {nickname})
+            takeover = True
+    if takeover:
+        log.info(f"User {nickname} taken over from another replica")
+        _publish_presence({'evict': nickname, 'token': session_tokens.get(sid)})
+    if stale_sid:
+        # Same browser session reconnecting before its old socket timed out
+        log.info(f"User {nickname} reclaimed from stale session {stale_sid}")
+        close_outbox(stale_sid)
+        socketio.server.disconnect(stale_sid, namespace='/')
+    
     with users_lock:
-        # Check if nickname already taken
-        if nickname in online_users.values():
+        if sid in online_users:
+            emit('join_error', {'error': 'Already joined'})
+            return
+        # Check if nickname already taken anywhere in the cluster
+        if _is_online(nickname):
             emit('join_error', {'error': 'Nickname already taken'})
             return
         online_users[sid] = nickname
+        nickname_index[nickname] = sid
+        _note_presence(added=[nickname])
+        users = _all_users()
+        session_rooms[sid] = room
+        first_member = room not in room_members
+        room_members.setdefault(room, set()).add(sid)
+        # Everything up to the cutoff is replayed as history; later messages
+        # reach the (held) outbox live, so nothing is doubled or reordered
+        cutoff = history.last_seq
+        outbox = client_outboxes.get(sid)
+        if outbox is not None:
+            outbox.hold()
+    
+    log.info(f"User joined: {nickname} ({room})")
     
-    print(f"User joined: {nickname}")
+    join_room(room)
+    # Start receiving the room's traffic before the first local member can post
+    if first_member:
+        request_room_binding('bind', room, wait=True)
     
-    # Notify all clients
-    emit('user_joined', {'nickname': nickname}, broadcast=True)
-    broadcast_users_list()
+    # Others learn about it from the next presence delta
+    with users_lock:
+        tokens = _local_tokens([nickname])
+    _publish_presence({'added': [nickname], 'tokens': tokens})
     
-    # Confirm to sender
-    emit('join_success', {'nickname': nickname})
+    # Replay what the client missed in one batched event; sequence cursors
+    # only apply to the history log they came from
+    backlog = []
+    try:
+        cursor = _as_number(data.get('cursor'), int) if data.get('epoch') == history.epoch else None
+        since = _as_number(data.get('since'), float)
+        backlog = history.replay(room, cursor=cursor, since=since, until=cutoff)
+    finally:
+        # Confirm to sender, with a full snapshot for its user list, then
+        # history ahead of any live messages queued meanwhile
+        emit('join_success', {'nickname': nickname, 'room': room})
+        emit('users_list', {'users': users})
+        payload = {'messages': backlog, 'epoch': history.epoch}
+        if outbox is not None:
+            outbox.release('history', payload)
+        else:
+            emit('history', payload)
 
 @socketio.on('send_message')
 def handle_send_message(data):
-    print(f"📥 Received send_message event: {data}")
-    
+    if not isinstance(data, dict):
+        return
     sid = request.sid
     with users_lock:
         nickname = online_users.get(sid)
+        room = session_rooms.get(sid)
     
     if not nickname:
-        print(f"⚠️ Message from unknown user (sid: {sid})")
+        log.warning(f"⚠️ Message from unknown user (sid: {sid})")
         return
     
-    text = data.get('text', '').strip()
+    text = data.get('text')
+    if not isinstance(text, str):
+        return
+    text = text.strip()
     if not text:
-        print(f"⚠️ Empty message from {nickname}")
         return
     
     msg = {
         'from': nickname,
         'text': text,
+        'room': room,
         'timestamp': time.time()
     }
     
-    print(f"📨 Message from {nickname}: {text[:50]}...")
+    messages_in.inc()
+    if log_sampled():
+        log.info(f"📨 Message from {nickname} in {room}: {text[:50]}...")
+    
+    share_typing(room, nickname, False)
     
-    # Broadcast directly via Socket.IO
-    print(f"📢 Broadcasting message to all clients...")
-    print(f"📋 Message data: {msg}")
-    socketio.emit('message', msg, namespace='/')
-    print(f"✅ Message broadcast complete")
+    # Hand off to the publisher; every replica hosting the room broadcasts it
+    publish_message(msg)
 
 @socketio.on('typing')
 def handle_typing(data):
+    if not isinstance(data, dict):
+        return
     sid = request.sid
     with users_lock:
         nickname = online_users.get(sid)
+        room = session_rooms.get(sid)
     
     if not nickname:
         return
     
-    is_typing = data.get('typing', False)
-    # Broadcast to all except sender
-    emit('user_typing', {'nickname': nickname, 'typing': is_typing}, broadcast=True, include_self=False)
+    # Aggregated into periodic typing_snapshot events on every replica hosting the room;
+    # entries expire after TYPING_TTL
+    share_typing(room, nickname, bool(data.get('typing', False)))
 
 if __name__ == '__main__':
+    # Exit through atexit on SIGTERM (docker stop) so other replicas hear we left
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    atexit.register(announce_shutdown)
     socketio.run(app, host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""In-process stand-in for the parts of pika that app.py uses
+
+Install it before importing app so a replica runs without RabbitMQ:
+
+    import fake_pika
+    sys.modules['pika'] = fake_pika
+
+Exchanges, queues and bindings live in one process-wide broker, so every
+connection opened by the publisher and the consumer sees the same routing.
+Replicas in separate processes do NOT share it; use a real broker for
+multi-replica runs.
+"""
+import itertools
+from eventlet.queue import LightQueue, Empty
+
+
+class PlainCredentials:
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+
+class ConnectionParameters:
+    def __init__(self, host='localhost', virtual_host='/', credentials=None, **kwargs):
+        self.host = host
+        self.virtual_host = virtual_host
+        self.credentials = credentials
+
+
+class BasicProperties:
+    def __init__(self, delivery_mode=None, content_type=None, **kwargs):
+        self.delivery_mode = delivery_mode
+        self.content_type = content_type
+
+
+class _Result:
+    """Shape of a queue_declare result: result.method.queue / .message_count"""
+
+    def __init__(self, queue, message_count):
+        self.method = self
+        self.queue = queue
+        self.message_count = message_count
+
+
+class _Deliver:
+    def __init__(self, delivery_tag, exchange, routing_key):
+        self.delivery_tag = delivery_tag
+        self.exchange = exchange
+        self.routing_key = routing_key
+
+
+def _topic_matches(pattern, routing_key):
+    """AMQP topic match: * is one word, # is zero or more"""
+    def match(p, k):
+        if not p:
+            return not k
+        if p[0] == '#':
+            return any(match(p[1:], k[i:]) for i in range(len(k) + 1))
+        if not k:
+            return False
+        return (p[0] == '*' or p[0] == k[0]) and match(p[1:], k[1:])
+    return match(pattern.split('.'), routing_key.split('.'))
+
+
+class _Broker:
+    def __init__(self):
+        self.exchanges = {}  # name -> type
+        self.queues = {}     # name -> LightQueue of (exchange, routing_key, properties, body)
+        self.bindings = {}   # exchange -> {(queue, routing_key)}
+        self.published = 0
+        self._names = itertools.count(1)
+
+    def declare_queue(self, name):
+        if not name:
+            name = f"amq.gen-{next(self._names)}"
+        self.queues.setdefault(name, LightQueue())
+        return name
+
+    def delete_queue(self, name):
+        self.queues.pop(name, None)
+        for bound in self.bindings.values():
+            for binding in [b for b in bound if b[0] == name]:
+                bound.discard(binding)
+
+    def route(self, exchange, routing_key, properties, body):
+        self.published += 1
+        kind = self.exchanges.get(exchange, 'fanout')
+        targets = set()
+        for queue, pattern in self.bindings.get(exchange, ()):
+            if kind == 'fanout' or (kind == 'topic' and _topic_matches(pattern, routing_key)) \
+                    or (kind == 'direct' and pattern == routing_key):
+                targets.add(queue)
+        for queue in targets:
+            if queue in self.queues:
+                self.queues[queue].put((exchange, routing_key, properties, body))
+
+
+broker = _Broker()
+
+
+class BlockingChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+        self._exclusive = []
+        self._consuming = None
+        self._tags = itertools.count(1)
+
+    def exchange_declare(self, exchange, exchange_type='direct', durable=False, **kwargs):
+        broker.exchanges.setdefault(exchange, exchange_type)
+
+    def queue_declare(self, queue='', exclusive=False, passive=False, **kwargs):
+        if passive:
+            return _Result(queue, broker.queues[queue].qsize())
+        name = broker.declare_queue(queue)
+        if exclusive:
+            self._exclusive.append(name)
+        return _Result(name, 0)
+
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        broker.bindings.setdefault(exchange, set()).add((queue, routing_key or queue))
+
+    def queue_unbind(self, queue, exchange, routing_key=None, **kwargs):
+        broker.bindings.get(exchange, set()).discard((queue, routing_key or queue))
+
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        pass
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        broker.route(exchange, routing_key, properties or BasicProperties(), body)
+
+    def consume(self, queue, inactivity_timeout=None, **kwargs):
+        self._consuming = broker.queues[queue]
+        while self.is_open:
+            try:
+                exchange, routing_key, properties, body = self._consuming.get(timeout=inactivity_timeout)
+            except Empty:
+                yield None, None, None
+                continue
+            yield _Deliver(next(self._tags), exchange, routing_key), properties, body
+
+    def get_waiting_message_count(self):
+        return self._consuming.qsize() if self._consuming is not None else 0
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        pass
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        pass
+
+    def close(self):
+        self.is_open = False
+        for name in self._exclusive:
+            broker.delete_queue(name)
+
+
+class BlockingConnection:
+    def __init__(self, parameters=None):
+        self.parameters = parameters
+        self.is_open = True
+        self._channels = []
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def channel(self):
+        ch = BlockingChannel(self)
+        self._channels.append(ch)
+        return ch
+
+    def close(self):
+        for ch in self._channels:
+            ch.close()
+        self.is_open = False
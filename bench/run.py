@@ -0,0 +1,401 @@
+"""Load generation and fan-out latency benchmark for app.py
+
+Starts replicas with bench/serve.py and connects a swarm of headless
+Socket.IO clients. The clients join rooms, chat and type at configurable
+rates. For each tier the run reports end-to-end delivery latency
+(send_message -> broker -> fan-out -> client), throughput, and CPU/RSS per
+replica.
+
+    python bench/run.py --tiers 100,1000,10000 --duration 30
+    python bench/run.py --broker rabbitmq --replicas 3 --tiers 1000
+
+The default --broker fake swaps pika for the in-process stand-in in
+fake_pika.py, so no RabbitMQ is needed. That broker lives inside one
+replica process, so multi-replica runs need --broker rabbitmq (the replicas
+read RABBITMQ_* from the environment as usual).
+
+--max-p99-ms and --min-delivered-rate make the run exit non-zero when a
+tier misses them, so it can gate a deploy. A tier that sends messages but
+delivers none always fails.
+
+Requires: pip install -r bench/requirements.txt
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLES_PER_WORKER = 200000
+
+
+# Replica processes
+
+class Replica:
+    def __init__(self, index, port, fake_broker, codec):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        cmd = [sys.executable, os.path.join(BENCH_DIR, 'serve.py'), '--port', str(port)]
+        if fake_broker:
+            cmd.append('--fake-broker')
+        env = dict(os.environ, INSTANCE_ID=f"bench-{index}", BROKER_CODEC=codec)
+        self.process = subprocess.Popen(cmd, env=env)
+        self.peak_rss = 0
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"replica on port {self.port} exited with {self.process.returncode}")
+            try:
+                with urllib.request.urlopen(self.url + '/health', timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"replica on port {self.port} not healthy after {timeout}s")
+
+    def cpu_seconds(self):
+        if psutil is not None:
+            times = psutil.Process(self.process.pid).cpu_times()
+            return times.user + times.system
+        with open(f"/proc/{self.process.pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def sample_rss(self):
+        if psutil is not None:
+            rss = psutil.Process(self.process.pid).memory_info().rss
+        else:
+            with open(f"/proc/{self.process.pid}/statm") as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+# Swarm workers (one process each, many asyncio clients per process)
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.typing = 0
+        self.samples = []
+        self.seen = 0
+        self.window = None  # (start, end) of the measured send window
+
+    def record(self, messages):
+        now = time.time()
+        for msg in messages:
+            try:
+                sent_at = float(msg['text'].split(' ', 1)[0])
+            except (KeyError, ValueError):
+                continue
+            if self.window is None or not self.window[0] <= sent_at <= self.window[1]:
+                continue
+            self.delivered += 1
+            # Reservoir sample keeps memory bounded at high delivery counts
+            self.seen += 1
+            latency = now - sent_at
+            if len(self.samples) < SAMPLES_PER_WORKER:
+                self.samples.append(latency)
+            else:
+                j = random.randrange(self.seen)
+                if j < SAMPLES_PER_WORKER:
+                    self.samples[j] = latency
+
+
+class BenchClient:
+    def __init__(self, index, url, room, config, stats):
+        import socketio
+        self.index = index
+        self.url = url
+        self.room = room
+        self.config = config
+        self.stats = stats
+        self.joined = asyncio.Event()
+        self.error = None
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on('join_success', self._on_join_success)
+        self.sio.on('join_error', self._on_join_error)
+        self.sio.on('message_batch', self._on_batch)
+        self.sio.on('message_batch_bin', self._on_batch_bin)
+
+    async def _on_join_success(self, data):
+        self.joined.set()
+
+    async def _on_join_error(self, data):
+        self.error = data.get('error')
+        self.joined.set()
+
+    async def _on_batch(self, data):
+        self.stats.record(data['messages'])
+
+    async def _on_batch_bin(self, data):
+        import msgpack
+        envelope = msgpack.unpackb(data, raw=False)
+        fields = envelope['fields']
+        self.stats.record([dict(zip(fields, row)) for row in envelope['rows']])
+
+    async def start(self):
+        await self.sio.connect(self.url, transports=['websocket'],
+                               auth={'codec': self.config['codec']}, wait_timeout=30)
+        await self.sio.emit('join', {'nickname': f"bench-{self.index}", 'room': self.room})
+        await asyncio.wait_for(self.joined.wait(), 30)
+        if self.error:
+            raise RuntimeError(self.error)
+
+    async def chat(self, deadline):
+        rate = self.config['msg_rate']
+        padding = 'x' * self.config['message_size']
+        while rate > 0:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.time() >= deadline:
+                return
+            await self.sio.emit('send_message', {'text': f"{time.time():.6f} {padding}"})
+            self.stats.sent += 1
+
+    async def type(self, deadline):
+        rate = self.config['typing_rate']
+        while rate > 0:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.time() >= deadline:
+                return
+            await self.sio.emit('typing', {'typing': True})
+            self.stats.typing += 1
+
+
+async def run_swarm(indexes, urls, config, ready, start, results):
+    stats = Stats()
+    clients = []
+    failures = 0
+    gate = asyncio.Semaphore(config['connect_concurrency'])
+
+    async def connect(i):
+        nonlocal failures
+        room = f"room-{i // config['room_size']}"
+        client = BenchClient(i, urls[i % len(urls)], room, config, stats)
+        async with gate:
+            try:
+                await client.start()
+                clients.append(client)
+            except Exception:
+                failures += 1
+
+    await asyncio.gather(*(connect(i) for i in indexes))
+    ready.put((len(clients), failures))
+
+    start_at = await asyncio.get_running_loop().run_in_executor(None, start.get)
+    await asyncio.sleep(max(start_at - time.time(), 0))
+    deadline = start_at + config['duration']
+    stats.window = (start_at, deadline)
+
+    tasks = [asyncio.ensure_future(c.chat(deadline)) for c in clients]
+    tasks += [asyncio.ensure_future(c.type(deadline)) for c in clients]
+    await asyncio.gather(*tasks)
+    # Let in-flight deliveries land before reporting
+    await asyncio.sleep(config['drain'])
+
+    for client in clients:
+        try:
+            await client.sio.disconnect()
+        except Exception:
+            pass
+    results.put({
+        'sent': stats.sent,
+        'delivered': stats.delivered,
+        'typing': stats.typing,
+        'samples': stats.samples,
+    })
+
+
+def worker_main(indexes, urls, config, ready, start, results):
+    raise_fd_limit()
+    asyncio.run(run_swarm(indexes, urls, config, ready, start, results))
+
+
+# Orchestration and reporting
+
+def raise_fd_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_tier(users, args):
+    config = {
+        'codec': args.codec,
+        'msg_rate': args.msg_rate,
+        'typing_rate': args.typing_rate,
+        'message_size': args.message_size,
+        'room_size': args.room_size,
+        'duration': args.duration,
+        'drain': args.drain,
+        'connect_concurrency': args.connect_concurrency,
+    }
+    replicas = [Replica(i, args.base_port + i, args.broker == 'fake', args.codec)
+                for i in range(args.replicas)]
+    try:
+        for replica in replicas:
+            replica.wait_ready()
+        urls = [replica.url for replica in replicas]
+
+        ctx = multiprocessing.get_context('spawn')
+        ready, start, results = ctx.Queue(), ctx.Queue(), ctx.Queue()
+        workers = min(args.workers, users)
+        shards = [list(range(w, users, workers)) for w in range(workers)]
+        processes = [ctx.Process(target=worker_main, args=(shard, urls, config, ready, start, results))
+                     for shard in shards]
+        for process in processes:
+            process.start()
+
+        connected = failed = 0
+        for _ in processes:
+            ok, bad = ready.get(timeout=args.ramp_timeout)
+            connected += ok
+            failed += bad
+
+        start_at = time.time() + 1
+        for _ in processes:
+            start.put(start_at)
+        time.sleep(max(start_at - time.time(), 0))
+        cpu_before = [replica.cpu_seconds() for replica in replicas]
+        while time.time() < start_at + args.duration:
+            for replica in replicas:
+                replica.sample_rss()
+            time.sleep(1)
+        cpu_after = [replica.cpu_seconds() for replica in replicas]
+
+        sent = delivered = 0
+        samples = []
+        for _ in processes:
+            result = results.get(timeout=args.drain + 60)
+            sent += result['sent']
+            delivered += result['delivered']
+            samples.extend(result['samples'])
+        for process in processes:
+            process.join()
+    finally:
+        for replica in replicas:
+            replica.stop()
+
+    samples.sort()
+    return {
+        'users': users,
+        'connected': connected,
+        'connect_failures': failed,
+        'rooms': (users + args.room_size - 1) // args.room_size,
+        'sent': sent,
+        'delivered': delivered,
+        'sent_per_sec': sent / args.duration,
+        'delivered_per_sec': delivered / args.duration,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'p999_ms': percentile(samples, 0.999) * 1000,
+        'replicas': [
+            {
+                'port': replica.port,
+                'cpu_percent': (after - before) / args.duration * 100,
+                'peak_rss_mb': replica.peak_rss / (1024 * 1024),
+            }
+            for replica, before, after in zip(replicas, cpu_before, cpu_after)
+        ],
+    }
+
+
+def print_report(results):
+    header = (f"{'users':>7} {'conn':>7} {'rooms':>6} {'sent/s':>9} {'deliv/s':>10} "
+              f"{'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}  replicas (cpu%, peak rss MB)")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        per_replica = ', '.join(f"{rep['cpu_percent']:.0f}%/{rep['peak_rss_mb']:.0f}MB" for rep in r['replicas'])
+        print(f"{r['users']:>7} {r['connected']:>7} {r['rooms']:>6} {r['sent_per_sec']:>9.1f} "
+              f"{r['delivered_per_sec']:>10.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{r['p999_ms']:>8.1f}  {per_replica}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tiers', default='100,1000,10000', help="comma-separated simulated user counts")
+    parser.add_argument('--duration', type=float, default=30, help="measured seconds per tier")
+    parser.add_argument('--drain', type=float, default=3, help="seconds to wait for in-flight deliveries")
+    parser.add_argument('--ramp-timeout', type=float, default=300, help="seconds allowed to connect a tier")
+    parser.add_argument('--room-size', type=int, default=50, help="simulated users per room")
+    parser.add_argument('--msg-rate', type=float, default=0.1, help="messages per second per user")
+    parser.add_argument('--typing-rate', type=float, default=0.5, help="typing events per second per user")
+    parser.add_argument('--message-size', type=int, default=64, help="padding bytes per message")
+    parser.add_argument('--codec', choices=['json', 'msgpack'], default='json', help="client and broker wire format")
+    parser.add_argument('--broker', choices=['fake', 'rabbitmq'], default='fake')
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--base-port', type=int, default=5100)
+    parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 8), help="client processes")
+    parser.add_argument('--connect-concurrency', type=int, default=100, help="parallel connects per worker")
+    parser.add_argument('--json', dest='json_path', help="also write results to this file")
+    parser.add_argument('--max-p99-ms', type=float, help="fail if any tier's p99 latency exceeds this")
+    parser.add_argument('--min-delivered-rate', type=float, help="fail if any tier delivers fewer msgs/s")
+    args = parser.parse_args()
+
+    if args.broker == 'fake' and args.replicas > 1:
+        parser.error("the fake broker is per-process; use --broker rabbitmq for multiple replicas")
+
+    raise_fd_limit()
+    tiers = [int(t) for t in args.tiers.split(',') if t]
+    results = []
+    for users in tiers:
+        print(f"▶ Tier {users} users ...", flush=True)
+        results.append(run_tier(users, args))
+    print_report(results)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    for r in results:
+        if r['sent'] and not r['delivered']:
+            print(f"❌ {r['users']} users: {r['sent']} messages sent, none delivered")
+            failed = True
+        if args.max_p99_ms is not None and not r['p99_ms'] <= args.max_p99_ms:
+            print(f"❌ {r['users']} users: p99 {r['p99_ms']:.1f} ms > {args.max_p99_ms} ms")
+            failed = True
+        if args.min_delivered_rate is not None and r['delivered_per_sec'] < args.min_delivered_rate:
+            print(f"❌ {r['users']} users: {r['delivered_per_sec']:.1f} deliveries/s < {args.min_delivered_rate}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
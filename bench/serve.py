@@ -0,0 +1,43 @@
+"""Run one app.py replica for benchmarking
+
+    python bench/serve.py --port 5001 [--fake-broker]
+
+With --fake-broker the pika module is replaced by the in-process stand-in
+from fake_pika.py, so no RabbitMQ is needed.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--fake-broker', action='store_true', help="use the in-process pika stand-in")
+    parser.add_argument('--max-connections', type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.fake_broker:
+        sys.path.insert(0, BENCH_DIR)
+        import fake_pika
+        sys.modules['pika'] = fake_pika
+
+    # Keep benchmark history out of the real data directory
+    os.environ.setdefault('HISTORY_DIR', tempfile.mkdtemp(prefix='chat-bench-history-'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    sys.path.insert(0, ROOT)
+    import app as chat
+
+    # eventlet.wsgi caps concurrent connections at 1024 by default
+    chat.socketio.run(chat.app, host=args.host, port=args.port, log_output=False,
+                      max_size=args.max_connections)
+
+
+if __name__ == '__main__':
+    main()
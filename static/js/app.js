@@ -1,17 +1,55 @@
 // Initialize socket connection
 console.log('Initializing Socket.IO...');
+// Ask for binary MessagePack message batches when the decoder loaded;
+// otherwise the server keeps sending JSON
+const binaryCodec = typeof MessagePack !== 'undefined';
+
+// Per-tab session token; lets a reconnect reclaim our nickname from the
+// server's not-yet-timed-out old socket
+function loadSessionToken() {
+  let token = sessionStorage.getItem('chatSessionToken');
+  if (!token) {
+    const bytes = new Uint8Array(16);
+    crypto.getRandomValues(bytes);
+    token = Array.from(bytes, function(b) { return b.toString(16).padStart(2, '0'); }).join('');
+    sessionStorage.setItem('chatSessionToken', token);
+  }
+  return token;
+}
+
 const socket = io({
   reconnection: true,
   reconnectionDelay: 1000,
-  reconnectionAttempts: 5
+  reconnectionAttempts: 5,
+  auth: { codec: binaryCodec ? 'msgpack' : 'json', token: loadSessionToken() }
 });
 
 let currentUser = null;
-let typingTimeout = null;
+let currentRoom = null;
+let lastTypingSent = 0;
+
+// Server expires typing state after a few seconds; refresh it while typing
+const TYPING_REFRESH_MS = 1000;
+let onlineUsers = new Set();
+
+// History cursor: last message seen, used to replay the gap on (re)join
+let lastSeq = null;
+let lastTimestamp = null;
+let historyEpoch = null;
+
+// Automatic rejoin retries while the old session is still registered
+const MAX_REJOIN_ATTEMPTS = 6;
+let rejoinAttempts = 0;
+let rejoinTimer = null;
 
 // Socket connection events
 socket.on('connect', function() {
   console.log('✅ Socket connected:', socket.id);
+  
+  // Rejoin after a dropped connection and catch up on missed messages
+  if (currentUser) {
+    sendJoin(currentUser, currentRoom);
+  }
 });
 
 socket.on('connect_error', function(error) {
@@ -26,6 +64,8 @@ socket.on('disconnect', function(reason) {
 function joinChat() {
   const nicknameInput = document.getElementById('nicknameInput');
   const nickname = nicknameInput.value.trim();
+  const roomInput = document.getElementById('roomInput');
+  const room = roomInput ? roomInput.value.trim().toLowerCase() : '';
   
   if (!nickname) {
     alert('Please enter a nickname');
@@ -34,7 +74,17 @@ function joinChat() {
   }
   
   console.log('🚀 Attempting to join with nickname:', nickname);
-  socket.emit('join', { nickname: nickname });
+  sendJoin(nickname, room || 'general');
+}
+
+function sendJoin(nickname, room) {
+  socket.emit('join', {
+    nickname: nickname,
+    room: room,
+    cursor: lastSeq,
+    since: lastTimestamp,
+    epoch: historyEpoch
+  });
 }
 
 // Logout function
@@ -58,8 +108,14 @@ function confirmLogout() {
   // Disconnect socket
   socket.disconnect();
   
-  // Reset current user
+  // Reset current user, pending rejoin and history cursor
+  clearTimeout(rejoinTimer);
+  rejoinAttempts = 0;
   currentUser = null;
+  currentRoom = null;
+  lastSeq = null;
+  lastTimestamp = null;
+  historyEpoch = null;
   
   // Clear message list
   const messageList = document.getElementById('messageList');
@@ -107,7 +163,7 @@ function sendMessage() {
   });
   
   input.value = '';
-  socket.emit('typing', { typing: false });
+  lastTypingSent = 0;
 }
 
 // Update user list
@@ -134,14 +190,8 @@ function updateUserList(users) {
   });
 }
 
-// Append message
-function appendMessage(nick, text, ts) {
-  const list = document.getElementById('messageList');
-  if (!list) {
-    console.error('Message list not found');
-    return;
-  }
-  
+// Build a single message element
+function buildMessageElement(nick, text, ts) {
   const div = document.createElement('div');
   div.className = nick === currentUser ? 'message me' : 'message';
   
@@ -175,7 +225,32 @@ function appendMessage(nick, text, ts) {
   div.appendChild(messageHeader);
   div.appendChild(messageBubble);
   
-  list.appendChild(div);
+  return div;
+}
+
+// Append message
+function appendMessage(nick, text, ts) {
+  appendMessages([{ from: nick, text: text, timestamp: ts }]);
+}
+
+// Append a batch of messages with a single DOM update
+function appendMessages(messages) {
+  const list = document.getElementById('messageList');
+  if (!list) {
+    console.error('Message list not found');
+    return;
+  }
+  
+  const fragment = document.createDocumentFragment();
+  messages.forEach(function(m) {
+    // Already shown (e.g. replayed and delivered live around a rejoin)
+    if (m.seq !== undefined && lastSeq !== null && m.seq <= lastSeq) return;
+    fragment.appendChild(buildMessageElement(m.from, m.text, m.timestamp));
+    if (m.seq !== undefined) lastSeq = m.seq;
+    lastTimestamp = m.timestamp;
+  });
+  
+  list.appendChild(fragment);
   list.scrollTop = list.scrollHeight;
 }
 
@@ -203,13 +278,17 @@ function appendSystemMessage(text) {
 socket.on('join_success', function(data) {
   console.log('✅ Join success:', data);
   currentUser = data.nickname;
+  rejoinAttempts = 0;
+  currentRoom = data.room;
   
   const myNickname = document.getElementById('myNickname');
+  const chatTitle = document.getElementById('chatTitle');
   const joinContainer = document.getElementById('joinContainer');
   const chatContainer = document.getElementById('chatContainer');
   const messageInput = document.getElementById('messageInput');
   
   if (myNickname) myNickname.textContent = 'You: ' + currentUser;
+  if (chatTitle) chatTitle.textContent = '# ' + currentRoom;
   if (joinContainer) joinContainer.style.display = 'none';
   if (chatContainer) chatContainer.style.display = 'flex';
   if (messageInput) messageInput.focus();
@@ -217,21 +296,42 @@ socket.on('join_success', function(data) {
 
 socket.on('join_error', function(data) {
   console.error('❌ Join error:', data);
+  
+  // Automatic rejoin: retry with backoff instead of alerting
+  if (currentUser && socket.connected && rejoinAttempts < MAX_REJOIN_ATTEMPTS) {
+    const delay = 1000 * Math.pow(2, rejoinAttempts);
+    rejoinAttempts++;
+    clearTimeout(rejoinTimer);
+    rejoinTimer = setTimeout(function() {
+      if (currentUser && socket.connected) sendJoin(currentUser, currentRoom);
+    }, delay);
+    return;
+  }
+  
+  rejoinAttempts = 0;
   alert(data.error || 'Failed to join chat');
 });
 
-socket.on('user_joined', function(data) {
-  console.log('👋 User joined:', data.nickname);
-  appendSystemMessage(data.nickname + ' joined the chat');
-});
-
-socket.on('user_left', function(data) {
-  console.log('👋 User left:', data.nickname);
-  appendSystemMessage(data.nickname + ' left the chat');
+socket.on('users_list', function(data) {
+  onlineUsers = new Set(data.users);
+  updateUserList(Array.from(onlineUsers));
 });
 
-socket.on('users_list', function(data) {
-  updateUserList(data.users);
+socket.on('presence_delta', function(data) {
+  data.removed.forEach(function(u) {
+    if (onlineUsers.delete(u) && currentUser) {
+      appendSystemMessage(u + ' left the chat');
+    }
+  });
+  data.added.forEach(function(u) {
+    if (!onlineUsers.has(u)) {
+      onlineUsers.add(u);
+      if (currentUser && u !== currentUser) {
+        appendSystemMessage(u + ' joined the chat');
+      }
+    }
+  });
+  updateUserList(Array.from(onlineUsers));
 });
 
 socket.on('message', function(data) {
@@ -239,16 +339,50 @@ socket.on('message', function(data) {
   appendMessage(data.from, data.text, data.timestamp);
 });
 
-socket.on('user_typing', function(data) {
+socket.on('message_batch', function(data) {
+  appendMessages(data.messages);
+});
+
+// Column-wise batch: { fields: [...], rows: [[...], ...] }
+function unpackEnvelope(envelope) {
+  if (!envelope.rows) return envelope.messages || [];
+  return envelope.rows.map(function(row) {
+    const msg = {};
+    envelope.fields.forEach(function(field, i) { msg[field] = row[i]; });
+    return msg;
+  });
+}
+
+socket.on('message_batch_bin', function(data) {
+  appendMessages(unpackEnvelope(MessagePack.decode(new Uint8Array(data))));
+});
+
+socket.on('history', function(data) {
+  console.log('📜 History received:', data.messages.length, 'messages');
+  // Sequence numbers are only comparable within one history log
+  if (data.epoch !== historyEpoch) lastSeq = null;
+  historyEpoch = data.epoch;
+  appendMessages(data.messages);
+});
+
+socket.on('typing_snapshot', function(data) {
   const indicator = document.getElementById('typingIndicator');
   if (!indicator) return;
   
-  if (data.typing) {
-    indicator.textContent = data.nickname + ' is typing...';
-    indicator.style.display = 'block';
-  } else {
+  const typers = data.users.filter(function(u) { return u !== currentUser; });
+  if (typers.length === 0) {
     indicator.style.display = 'none';
+    return;
   }
+  
+  if (typers.length === 1) {
+    indicator.textContent = typers[0] + ' is typing...';
+  } else if (typers.length <= 3) {
+    indicator.textContent = typers.join(', ') + ' are typing...';
+  } else {
+    indicator.textContent = typers.length + ' people are typing...';
+  }
+  indicator.style.display = 'block';
 });
 
 // DOM Ready
@@ -279,6 +413,17 @@ window.addEventListener('DOMContentLoaded', function() {
     console.error('❌ Nickname input not found');
   }
 
+  // Room input - Enter key
+  const roomInput = document.getElementById('roomInput');
+  if (roomInput) {
+    roomInput.addEventListener('keypress', function(e) {
+      if (e.key === 'Enter') {
+        e.preventDefault();
+        joinChat();
+      }
+    });
+  }
+
   // Send button
   const sendBtn = document.getElementById('sendBtn');
   if (sendBtn) {
@@ -332,12 +477,11 @@ window.addEventListener('DOMContentLoaded', function() {
     messageInput.addEventListener('input', function() {
       if (!currentUser) return;
       
-      socket.emit('typing', { typing: true });
-      
-      clearTimeout(typingTimeout);
-      typingTimeout = setTimeout(function() {
-        socket.emit('typing', { typing: false });
-      }, 1000);
+      const now = Date.now();
+      if (now - lastTypingSent >= TYPING_REFRESH_MS) {
+        lastTypingSent = now;
+        socket.emit('typing', { typing: true });
+      }
     });
     console.log('✅ Message input listener attached');
   }